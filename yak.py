@@ -11,7 +11,16 @@ import argparse
 import logging
 import re
 import json
+import cPickle
+import copy
+import collections
+import time
+import shutil
 import subprocess
+import threading
+import gzip
+from cStringIO import StringIO
+from HTMLParser import HTMLParser
 
 logging.basicConfig()
 logger = logging.getLogger("wg")
@@ -49,44 +58,547 @@ def deep_copy(d, depth=4):
         return d
 
 
+HASH_CHUNK_SIZE = 1024*1024
+
+
 def hash(path):
-    data = open(path).read()
-    h = sha.sha(data)
+    h = sha.sha()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), ''):
+            h.update(chunk)
     return h.hexdigest()
 
 
+stats = collections.Counter()
+
+TIMINGS_TOP = 15
+
+timings = {
+    'enabled': False,
+    'start': 0,
+    'events': []
+}
+
+
+class timer(object):
+    def __init__(self, category, name):
+        self.category = category
+        self.name = name
+
+    def __enter__(self):
+        if timings['enabled']:
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if timings['enabled']:
+            timings['events'].append((self.category, self.name, self.start, time.time()-self.start, os.getpid()))
+
+
+def timed_filter(name, f):
+    def timed(*args, **kwargs):
+        with timer('filter', name):
+            return f(*args, **kwargs)
+    for attr in ['contextfilter', 'evalcontextfilter', 'environmentfilter']:
+        if getattr(f, attr, False):
+            setattr(timed, attr, True)
+    timed.timed = f
+    return timed
+
+
+def report_timings(trace_path):
+    totals = {}
+    for (category, name, start, duration, pid) in timings['events']:
+        total = totals.setdefault(category, {}).setdefault(name, [0, 0.0])
+        total[0] += 1
+        total[1] += duration
+    for category in sorted(totals):
+        print("%s (top %d of %d):" % (category.upper(), min(TIMINGS_TOP, len(totals[category])), len(totals[category])))
+        for (name, (calls, duration)) in sorted(totals[category].items(), key=lambda item: -item[1][1])[:TIMINGS_TOP]:
+            print("  %9.3fs %7d calls %9.3fms/call  %s" % (duration, calls, 1000*duration/calls, name))
+    trace = {
+        'displayTimeUnit': 'ms',
+        'traceEvents': [{
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int((start-timings['start'])*1000000),
+            'dur': int(duration*1000000),
+            'pid': pid,
+            'tid': pid
+        } for (category, name, start, duration, pid) in timings['events']]
+    }
+    with open(trace_path, 'w') as f:
+        json.dump(trace, f)
+    print("Trace written to", trace_path)
+
+fingerprints = {
+    'cache': {},
+    'updated': {}
+}
+
+
+def fingerprint(path):
+    st = os.stat(path)
+    key = [st.st_size, st.st_mtime, st.st_ino]
+    cached = fingerprints['cache'].get(path, None)
+    if cached is not None and cached[0] == key:
+        stats['fingerprint_hits'] += 1
+        return cached[1]
+    stats['fingerprint_misses'] += 1
+    h = hash(path)
+    fingerprints['cache'][path] = fingerprints['updated'][path] = [key, h]
+    return h
+
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+def cache_get(cache_dir, key):
+    path = os.path.join(cache_dir, key[:2], key)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    os.utime(path, None)
+    return data
+
+
+def temp_path(path):
+    # Unique per process and per thread, install threads may write the same file
+    return '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+
+
+def cache_put(cache_dir, key, data):
+    path = os.path.join(cache_dir, key[:2], key)
+    mkdir_p(os.path.dirname(path))
+    tmp_path = temp_path(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another writer stored the same key first
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if not os.path.exists(path):
+            raise
+
+
+def same_contents(path, other):
+    try:
+        if os.path.getsize(path) != os.path.getsize(other):
+            return False
+        with open(path, 'rb') as f, open(other, 'rb') as g:
+            while True:
+                chunk = f.read(COPY_CHUNK_SIZE)
+                if chunk != g.read(COPY_CHUNK_SIZE):
+                    return False
+                if chunk == '':
+                    return True
+    except (IOError, OSError):
+        return False
+
+
+def write_atomic(path, chunks):
+    # Readers (and a crashed build) never see a partially written file and
+    # unchanged files keep their mtime
+    tmp_path = temp_path(path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                f.write(chunk)
+        if same_contents(tmp_path, path):
+            os.remove(tmp_path)
+            return 'unchanged'
+        status = 'changed' if os.path.exists(path) else 'added'
+        os.rename(tmp_path, path)
+        return status
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Files produced by the current build, path -> added, changed or unchanged
+output_files = {}
+
+
+def prune_cache(cache_dir, max_size):
+    entries = [(os.stat(path), path) for path in list_files(cache_dir)]
+    size = sum([st.st_size for (st, path) in entries])
+    for (st, path) in sorted(entries, key=lambda e: e[0].st_mtime):
+        if size <= max_size:
+            break
+        os.remove(path)
+        size -= st.st_size
+
+
+def list_files(path):
+    ret = []
+    for (root, dirs, files) in os.walk(path):
+        for f in files:
+            ret.append(os.path.join(root, f))
+    return sorted(ret)
+
+
 def pipe(program, input, cwd=None):
     p = subprocess.Popen(program, stdout=subprocess.PIPE, stdin=subprocess.PIPE, shell=True, cwd=cwd)
     return p.communicate(input)[0]
 
+
 try:
     from scss import Scss
-    import os
-    compiler = Scss()
 
     def sass_filter(bytes, cwd):
-        os.chdir(cwd)
-        return compiler.compile(bytes)
+        # Imports are resolved relative to the source instead of the
+        # working directory, which is shared by all threads
+        compiler = Scss(search_paths=[cwd])
+        output = compiler.compile(bytes)
+        files = [os.path.join(d, f) for (d, f) in compiler.source_files]
+        return output, [f for f in files if os.path.isfile(f)]
 except:
     def sass_filter(bytes, cwd):
-        return pipe('sass --scss', bytes, cwd=cwd)
+        # The files imported by the sass command are not known
+        return pipe('sass --scss', bytes, cwd=cwd), None
+
+# Filters which read other files return them together with the output
+sass_filter.reads_files = True
+
+
+HTML_MINIFY_PATTERN = re.compile(r"""
+    (?P<raw><(?P<raw_tag>pre|textarea|script)\b[^>]*>[\s\S]*?</(?P=raw_tag)\s*>)
+    |
+    (?P<style><style\b[^>]*>)(?P<css>[\s\S]*?)(?P<style_end></style\s*>)
+    |
+    (?P<space>(?:\s|<!--(?!\[if|<!)[\s\S]*?-->)+)
+    |
+    (?P<tag><[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>)
+""", re.VERBOSE | re.IGNORECASE)
+
+HTML_COMMENT_PATTERN = re.compile(r'<!--[\s\S]*?-->')
+
+
+def minify_html(html):
+    # Whitespace is collapsed rather than removed, it may separate inline
+    # elements; pre, textarea and script contents and tags are kept as is
+    def minify(match):
+        if match.group('style') is not None:
+            return match.group('style')+minify_css(match.group('css'))+match.group('style_end')
+        elif match.group('space') is not None:
+            space = HTML_COMMENT_PATTERN.sub('', match.group('space'))
+            if space == '':
+                return ''
+            return '\n' if '\n' in space else ' '
+        return match.group(0)
+    return HTML_MINIFY_PATTERN.sub(minify, html)
+
+
+CSS_TOKEN_PATTERN = re.compile(r"""
+    (?P<string>"(?:\\[\s\S]|[^"\\])*"|'(?:\\[\s\S]|[^'\\])*')
+    |
+    (?P<comment>/\*[\s\S]*?\*/)
+""", re.VERBOSE)
+
+CSS_SPACE_PATTERN = re.compile(r'\s+')
+CSS_PUNCTUATION_PATTERN = re.compile(r' ?([{};,>]) ?')
+
+
+def minify_css_code(code):
+    code = CSS_SPACE_PATTERN.sub(' ', code)
+    code = CSS_PUNCTUATION_PATTERN.sub(r'\1', code)
+    # Spaces before a colon may separate a pseudo class from its parent
+    return code.replace(': ', ':').replace(';}', '}')
+
+
+def minify_css(css):
+    ret = []
+    code = []
+    pos = 0
+    for match in CSS_TOKEN_PATTERN.finditer(css):
+        code.append(css[pos:match.start()])
+        pos = match.end()
+        if match.group('comment') is not None and not match.group(0).startswith('/*!'):
+            code.append(' ')
+            continue
+        ret.append(minify_css_code(''.join(code)))
+        ret.append(match.group(0))
+        code = []
+    code.append(css[pos:])
+    ret.append(minify_css_code(''.join(code)))
+    return ''.join(ret).strip()
+
+
+JS_TOKEN_PATTERN = re.compile(r"""
+    (?P<space>(?:\s|//[^\n]*|/\*(?!!)[\s\S]*?\*/)+)
+    |
+    (?P<string>"(?:\\[\s\S]|[^"\\\n])*"|'(?:\\[\s\S]|[^'\\\n])*')
+    |
+    (?P<comment>/\*![\s\S]*?\*/)
+    |
+    (?P<word>[\w$]+)
+    |
+    (?P<other>[\s\S])
+""", re.VERBOSE)
+
+JS_REGEX_PATTERN = re.compile(r'/(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[\w$]*')
+
+# The text of a template literal up to its end or up to a substitution
+JS_TEMPLATE_PATTERN = re.compile(r'(?:\\[\s\S]|\$(?!\{)|[^`\\$])*(?:`|\$\{)')
+
+# Words after which a slash starts a regular expression rather than a division
+JS_REGEX_KEYWORDS = set(['return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+                         'throw', 'case', 'do', 'else', 'yield', 'await'])
+
+
+def js_word_char(c):
+    return c.isalnum() or c in '_$' or ord(c) > 127
+
+
+def js_separator(prev, next, space, after_regex=False):
+    if space == '\n':
+        # Newlines are kept where automatic semicolon insertion may need them
+        if prev in '{;,([' or next in '})],;':
+            return ''
+        return '\n'
+    # A word right after a regular expression would become its flags
+    if js_word_char(next) and (js_word_char(prev) or after_regex):
+        return ' '
+    if prev+next in ['++', '--', '//', '/*', '<!'] or (js_word_char(prev) and next == '.'):
+        return ' '
+    return ''
+
+
+def minify_js(js):
+    ret = []
+    space = None
+    regex_allowed = True
+    after_regex = False
+    # Brace depth of each open template literal substitution
+    templates = []
+    # A slash after ')' may start a regular expression as well as a division,
+    # whitespace is kept up to the next slash on the same line
+    keep_space = False
+    pos = 0
+    while pos < len(js):
+        token = None
+        # A slash where an operand is expected starts a regular expression;
+        # when in doubt it is kept as a literal
+        if js[pos] == '/' and regex_allowed and js[pos+1:pos+2] not in ['/', '*']:
+            match = JS_REGEX_PATTERN.match(js, pos)
+            if match is not None:
+                token = match.group(0)
+                regex_allowed = False
+        elif js[pos] == '`' or (js[pos] == '}' and len(templates) > 0 and templates[-1] == 0):
+            match = JS_TEMPLATE_PATTERN.match(js, pos+1)
+            if match is not None:
+                token = js[pos:match.end()]
+                if js[pos] == '}':
+                    templates.pop()
+                if token.endswith('${'):
+                    templates.append(0)
+                    regex_allowed = True
+                else:
+                    regex_allowed = False
+        if token is None:
+            match = JS_TOKEN_PATTERN.match(js, pos)
+            token = match.group(0)
+            if match.group('space') is not None:
+                if keep_space and '\n' not in token:
+                    ret.append(token)
+                elif space != '\n':
+                    space = '\n' if '\n' in token else ' '
+                keep_space = keep_space and '\n' not in token
+                pos = match.end()
+                continue
+            elif match.group('word') is not None:
+                regex_allowed = token in JS_REGEX_KEYWORDS
+            elif match.group('other') is not None:
+                regex_allowed = token not in ')]'
+                if token == '/' and len(ret) > 0:
+                    keep_space = ret[-1] == ')' or (keep_space and ret[-1] == '\\')
+                elif token in '{}' and len(templates) > 0:
+                    templates[-1] += 1 if token == '{' else -1
+            elif match.group('string') is not None:
+                regex_allowed = False
+        if space is not None and len(ret) > 0:
+            ret.append(js_separator(ret[-1][-1], token[0], space, after_regex))
+        space = None
+        after_regex = match.re is JS_REGEX_PATTERN
+        ret.append(token)
+        pos = match.end()
+    return ''.join(ret)
+
+
+def minify_html_filter(bytes, cwd):
+    return minify_html(bytes)
+
+
+def minify_css_filter(bytes, cwd):
+    return minify_css(bytes)
+
+
+def minify_js_filter(bytes, cwd):
+    return minify_js(bytes)
+
 
 INSTALL_FILTERS = {
-    'sass': sass_filter
+    'sass': sass_filter,
+    'minify-html': minify_html_filter,
+    'minify-css': minify_css_filter,
+    'minify-js': minify_js_filter
+}
+
+
+# Long running filter processes, configured by name in the filter_workers
+# config key. Each request is a '<length> <directory>' line followed by the
+# file contents, the reply is a '<length>' line followed by the output.
+filter_workers = {
+    'commands': {},
+    'idle': {},
+    'lock': threading.Lock()
+}
+
+
+class filter_worker(object):
+    def __init__(self, name, command):
+        self.name = name
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stdin=subprocess.PIPE, shell=True)
+
+    def run(self, input, cwd):
+        self.process.stdin.write('%d %s\n' % (len(input), os.path.abspath(cwd)))
+        self.process.stdin.write(input)
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if not header.strip().isdigit():
+            raise BaseException("Filter worker '"+self.name+"' failed: "+header)
+        output = self.process.stdout.read(int(header))
+        if len(output) != int(header):
+            raise BaseException("Filter worker '"+self.name+"' failed: truncated output")
+        return output
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def run_filter_worker(name, input, cwd):
+    with filter_workers['lock']:
+        idle = filter_workers['idle'].setdefault(name, [])
+        worker = idle.pop() if len(idle) > 0 else None
+    if worker is None:
+        worker = filter_worker(name, filter_workers['commands'][name])
+    try:
+        output = worker.run(input, cwd)
+    except:
+        worker.process.kill()
+        raise
+    with filter_workers['lock']:
+        idle.append(worker)
+    return output
+
+
+def stop_filter_workers():
+    with filter_workers['lock']:
+        for workers in filter_workers['idle'].values():
+            for worker in workers:
+                worker.close()
+        filter_workers['idle'] = {}
+
+
+filter_cache = {
+    'dir': None,
+    'max_size': 0
 }
 
 
+# Returns the output together with the other files read by the filters,
+# None when these are not known
+def run_filters(s, filters, src_dir):
+    deps = []
+    for f in filters:
+        if f in INSTALL_FILTERS:
+            if hasattr(INSTALL_FILTERS[f], 'reads_files'):
+                (s, files) = INSTALL_FILTERS[f](s, cwd=src_dir)
+                deps = None if deps is None or files is None else deps + files
+            else:
+                s = INSTALL_FILTERS[f](s, cwd=src_dir)
+        elif f in filter_workers['commands']:
+            s = run_filter_worker(f, s, src_dir)
+        else:
+            # External commands may read any file
+            s = pipe(f, s, cwd=src_dir)
+            deps = None
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return s, deps
+
+
+def filter_cache_key(s, filters, src_dir):
+    h = sha.sha(json.dumps([filters, filter_workers['commands'], src_dir]))
+    h.update(s)
+    return h.hexdigest()
+
+
+def file_signatures(paths):
+    if paths is None:
+        return None
+    return dict([(path, file_signature(path)) for path in paths])
+
+
+def signatures_match(signatures):
+    if signatures is None:
+        return False
+    return all([file_signature(path) == sig for (path, sig) in signatures.items()])
+
+
+# Signatures of the files read by the filters of each installed asset, dest
+# -> path -> signature, None when these are not known
+filter_deps = {}
+
+
+COPY_CHUNK_SIZE = 1024*1024
+
+
 def cp(src, dst, create_parents=False, filters=[]):
     src_dir = os.path.dirname(src)
     if create_parents:
         mkdir_p(os.path.dirname(dst))
+    if len(filters) == 0:
+        filter_deps[dst] = {}
+        if same_contents(src, dst):
+            return 'unchanged'
+        status = 'changed' if os.path.exists(dst) else 'added'
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            shutil.copyfileobj(src_file, dst_file, COPY_CHUNK_SIZE)
+        return status
     s = open(src).read()
-    for f in filters:
-        if f in INSTALL_FILTERS:
-            s = INSTALL_FILTERS[f](s, cwd=src_dir)
-        else:
-            s = pipe(f, s, cwd=src_dir)
-    open(dst, 'w').write(s)
+    cached = None
+    if filter_cache['dir'] is not None:
+        key = filter_cache_key(s, filters, src_dir)
+        cached = cache_get(filter_cache['dir'], key)
+        if cached is not None:
+            cached = cPickle.loads(cached)
+            if not signatures_match(cached[0]):
+                cached = None
+    if cached is None:
+        (s, files) = run_filters(s, filters, src_dir)
+        deps = file_signatures(files)
+        # Output depending on unknown files is never reused
+        if filter_cache['dir'] is not None and deps is not None:
+            cache_put(filter_cache['dir'], key, cPickle.dumps((deps, s), cPickle.HIGHEST_PROTOCOL))
+    else:
+        stats['filter_cache_hits'] += 1
+        (deps, s) = cached
+    filter_deps[dst] = deps
+    return write_atomic(dst, [s])
 
 
 def mkdir_p(path):
@@ -98,26 +610,58 @@ def mkdir_p(path):
             if not os.path.isdir(path):
                 raise BaseException("Path component '"+parent+d+"' is a file")
         else:
-            os.mkdir(path)
+            try:
+                os.mkdir(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
         parent = parent + d + posixpath.sep
 
 
-def ls(path, pattern, recursive):
-    ret = []
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def list_dir(path, listings=None):
+    if listings is not None and path in listings:
+        return listings[path]
+    # scandir knows the entry types without an extra stat per entry
+    if scandir is not None:
+        entries = [(entry.name, entry.is_dir()) for entry in scandir(path)]
+    else:
+        entries = [(node, os.path.isdir(os.path.join(path, node))) for node in os.listdir(path)]
+    if listings is not None:
+        listings[path] = entries
+    return entries
+
+
+def ls(path, pattern, recursive, listings=None):
+    if isinstance(pattern, basestring):
+        pattern = re.compile(pattern)
     if not os.path.isdir(path):
         return [path]
-    for node in os.listdir(path):
+    ret = []
+    ls_dir(path, pattern, recursive, listings, ret)
+    return ret
+
+
+def ls_dir(path, pattern, recursive, listings, ret):
+    for (node, is_dir) in list_dir(path, listings):
         try:
-            if re.match(pattern, node):
+            if pattern.match(node):
                 node_path = os.path.join(path, node)
-                if os.path.isdir(node_path):
+                if is_dir:
                     if recursive:
-                        ret.extend(ls(os.path.join(node_path), pattern, recursive))
+                        ls_dir(node_path, pattern, recursive, listings, ret)
                 else:
                     ret.append(node_path)
         except Exception as e:
-            logger.error("Exception "+str(e)+" when listing assets in '"+path+"' matching pattern '"+pattern+"'")
-    return ret
+            logger.error("Exception "+str(e)+" when listing assets in '"+path+"' matching pattern '"+pattern.pattern+"'")
 
 
 def get_extension(path):
@@ -142,10 +686,45 @@ def strip_extension(path):
 
 
 import jinja2
-from jinja2.filters import environmentfilter
-jinja_env = jinja2.Environment(extensions=['jinja2.ext.autoescape'])
+from jinja2.filters import contextfilter
+
+
+class yak_environment(jinja2.Environment):
+    def get_template(self, name, parent=None, globals=None):
+        tpl = super(yak_environment, self).get_template(name, parent=parent, globals=globals)
+        record_dep('templates', tpl.filename)
+        return tpl
+
+
+class yak_bytecode_cache(jinja2.FileSystemBytecodeCache):
+    def dump_bytecode(self, bucket):
+        # Write atomically, render workers may read the cache concurrently
+        filename = self._get_cache_filename(bucket)
+        tmp_filename = temp_path(filename)
+        with open(tmp_filename, 'wb') as f:
+            bucket.write_bytecode(f)
+        os.rename(tmp_filename, filename)
+
+
+jinja_env = yak_environment(extensions=['jinja2.ext.autoescape'])
 jinja_env.assets = {}
 jinja_env.missing_assets = {}
+jinja_env.asset_urls = {}
+jinja_env.deps = None
+
+
+def new_deps():
+    return {
+        'sources': set(),
+        'templates': set(),
+        'data': set(),
+        'assets': set()
+    }
+
+
+def record_dep(kind, value):
+    if jinja_env.deps is not None and value is not None:
+        jinja_env.deps[kind].add(value)
 
 
 def json_filter(value):
@@ -153,12 +732,13 @@ def json_filter(value):
 
 
 def get_asset_url(env, path):
+    record_dep('assets', path)
     if not path in env.assets:
         logger.error("Asset '"+path+"' not found")
         env.missing_assets[path] = True
         return path
     elif env.assets[path]['hash'] is None:
-        h = hash(env.assets[path]['src'])
+        h = fingerprint(env.assets[path]['src'])
         env.assets[path]['hash'] = h
         env.assets[path]['copy'] = True
         return path + '?' + h
@@ -166,8 +746,11 @@ def get_asset_url(env, path):
         return path + '?' + env.assets[path]['hash']
 
 
-@environmentfilter
-def asset_filter(env, value, asset_path, **kwargs):
+# A contextfilter is never constant-folded into the compiled template, so
+# asset usage (and hashes) are resolved on every render
+@contextfilter
+def asset_filter(context, value, asset_path, **kwargs):
+    env = context.environment
     if len(value) > 0:
         path = asset_path+'/'+value
     else:
@@ -178,22 +761,67 @@ def asset_filter(env, value, asset_path, **kwargs):
     return path
 
 
+# src, href and srcset attributes and css url() references
 HTML_ASSET_PATTERN = re.compile("""
-    (?P<full>(?P<attr>src\s*=\s*)(?P<quote>["'])
-    (?P<url>[^'"]*)["'])
+    (?<![\w-])(?P<attr>(?P<name>src|href|srcset)\s*=\s*)(?P<quote>["'])
+    (?P<url>[^'"]*)(?P=quote)
+    |
+    (?<![\w-])(?P<css>url\(\s*)(?P<css_quote>["']?)
+    (?P<css_url>[^'"()\s]*)(?P=css_quote)(?P<css_end>\s*\))
 """, re.VERBOSE | re.IGNORECASE)
 
 
+def rewrite_asset_url(env, url, report_missing=False):
+    if url in env.asset_urls:
+        record_dep('assets', url)
+        return env.asset_urls[url]
+    if url.startswith('cdn://'):
+        return env.config['cdn'] + url[5:]
+    # Skip relative and external urls and urls which already carry a query
+    if not url.startswith('/') or url.startswith('//') or '?' in url:
+        return url
+    # Links to pages are not assets, only src urls must refer to one
+    if not report_missing and url not in env.assets:
+        return url
+    ret = get_asset_url(env, url)
+    if url in env.assets:
+        env.asset_urls[url] = ret
+    return ret
+
+
+# A srcset candidate is a url up to whitespace, followed by a descriptor up
+# to the next comma unless the url ends with commas
+SRCSET_URL_PATTERN = re.compile(r'(?P<sep>[\s,]*)(?P<url>[^\s,]\S*?)(?P<commas>,*)(?=\s|$)')
+SRCSET_DESCRIPTOR_PATTERN = re.compile(r'[^,]*')
+
+
+def rewrite_srcset(env, srcset):
+    ret = []
+    pos = 0
+    while True:
+        m = SRCSET_URL_PATTERN.match(srcset, pos)
+        if m is None:
+            break
+        ret.append(m.group('sep')+rewrite_asset_url(env, m.group('url'))+m.group('commas'))
+        pos = m.end()
+        if m.group('commas') == '':
+            m = SRCSET_DESCRIPTOR_PATTERN.match(srcset, pos)
+            ret.append(m.group())
+            pos = m.end()
+    return ''.join(ret)+srcset[pos:]
+
+
 def scan_html_for_assets(env, html):
 
     def add_url_hash(match):
         match = match.groupdict()
-        if match['url'].startswith('/'):
-            return match['attr']+match['quote'] + get_asset_url(env,match['url'])+match['quote']
-        elif match['url'].startswith('cdn://'):
-            return match['attr']+match['quote'] + env.config['cdn'] + match['url'][5:] +match['quote']
+        if match['css'] is not None:
+            return match['css']+match['css_quote']+rewrite_asset_url(env, match['css_url'])+match['css_quote']+match['css_end']
+        elif match['name'].lower() == 'srcset':
+            url = rewrite_srcset(env, match['url'])
         else:
-            return match['full']
+            url = rewrite_asset_url(env, match['url'], report_missing=(match['name'].lower() == 'src'))
+        return match['attr']+match['quote']+url+match['quote']
     return HTML_ASSET_PATTERN.sub(add_url_hash, html)
 
 def youtube_filter(video, playlist, width='"853"', height='"480"'):
@@ -244,13 +872,26 @@ def notequalto_test(a, b):
 
 
 template_cache = {}
+template_names = {'names': None}
+
+
+def clear_template_cache():
+    template_cache.clear()
+    template_names['names'] = None
 
 
 def find_template(tpl_name):
+    if template_names['names'] is None:
+        try:
+            template_names['names'] = set(jinja_env.loader.list_templates())
+        except Exception:
+            template_names['names'] = False
     parts = tpl_name.split('.')
     tpl_extension = parts[-1]
     for i in range(len(parts)-1, 0, -1):
         test_name = '.'.join(parts[:i]+[tpl_extension])
+        if template_names['names'] and test_name not in template_names['names']:
+            continue
         try:
             return jinja_env.get_template(test_name)
         except jinja2.TemplateNotFound:
@@ -264,14 +905,99 @@ def find_template(tpl_name):
 def render_template(tpl_name, context):
     if not tpl_name in template_cache:
         template_cache[tpl_name] = find_template(tpl_name)
-    return template_cache[tpl_name].render(context)
+    record_dep('templates', template_cache[tpl_name].filename)
+    with timer('template', tpl_name):
+        return template_cache[tpl_name].render(context)
+
+
+def stream_template(tpl_name, context):
+    if not tpl_name in template_cache:
+        template_cache[tpl_name] = find_template(tpl_name)
+    record_dep('templates', template_cache[tpl_name].filename)
+    with timer('template', tpl_name):
+        for chunk in template_cache[tpl_name].generate(context):
+            yield chunk
+
+
+string_templates = {
+    'cache': jinja2.utils.LRUCache(1000)
+}
 
 
 def render_from_string(src, context):
-    tpl = jinja_env.from_string(src)
+    tpl = None
+    if string_templates['cache'] is not None:
+        tpl = string_templates['cache'].get(src)
+    if tpl is None:
+        stats['string_template_misses'] += 1
+        tpl = jinja_env.from_string(src)
+        if string_templates['cache'] is not None:
+            string_templates['cache'][src] = tpl
+    else:
+        stats['string_template_hits'] += 1
     return tpl.render(context)
 
 
+source_deps = {}
+
+
+class webnode(dict):
+    def __getitem__(self, key):
+        value = super(webnode, self).__getitem__(key)
+        if key == 'Content':
+            record_dep('sources', self.get('Source', None))
+            if isinstance(value, lazy_content):
+                return value.load()
+        return value
+
+    def deep_copy(self, depth=3):
+        ret = webnode()
+        for (k, v) in self.items():
+            ret[k] = deep_copy(v, depth=depth)
+        return ret
+
+
+# A copy-on-write view of a node: keys set on the view are stored in the
+# view, everything else (Meta, Content, Children, ...) is read from the base
+class webnode_view(collections.MutableMapping):
+    def __init__(self, base, overrides=None):
+        self._base = base
+        self._overrides = overrides or {}
+
+    def __getitem__(self, key):
+        if key in self._overrides:
+            return self._overrides[key]
+        return self._base[key]
+
+    def __setitem__(self, key, value):
+        self._overrides[key] = value
+
+    def __delitem__(self, key):
+        del self._overrides[key]
+
+    def __contains__(self, key):
+        return key in self._overrides or key in self._base
+
+    def __iter__(self):
+        for key in self._overrides:
+            yield key
+        for key in self._base:
+            if key not in self._overrides:
+                yield key
+
+    def __len__(self):
+        return len(set(self._overrides) | set(self._base))
+
+    def deep_copy(self, depth=3):
+        return webnode_view(self._base, dict(self._overrides))
+
+
+def group_page(page_template):
+    group = dict(page_template['Group'])
+    group['Children'] = webnode_list([])
+    return webnode_view(page_template, {'Group': group})
+
+
 class webnode_list(list):
     def __init__(self, *args, **kwargs):
         super(webnode_list, self).__init__(*args, **kwargs)
@@ -320,7 +1046,7 @@ def build_web_tree(path, base_dir='./sources', default_template_base='base', par
     tpl_base = path[len(base_dir):].replace('/', '.').strip('.')
     if tpl_base == '':
         tpl_base = default_template_base
-    tree = {
+    tree = webnode({
         "Content": "",
         "Format": "raw",
         "Meta": {
@@ -334,8 +1060,9 @@ def build_web_tree(path, base_dir='./sources', default_template_base='base', par
         "Parent": parent,
         "Name": os.path.basename(path),
         "URL": path[len(base_dir):]+'/',
-        "Type": "index"
-    }
+        "Type": "index",
+        "Source": None
+    })
     position = 0
     have_index = False
     for i in index_files:
@@ -344,10 +1071,12 @@ def build_web_tree(path, base_dir='./sources', default_template_base='base', par
             if have_index:
                 logger.warn("Multiple index files in " + path)
             position = position + 1
-            index = load_file(ipath)
+            index = load_source(ipath)
             tree['Meta'].update(index['Meta'])
             tree['Format'] = index['Format']
-            tree['Content'] = index['Content']
+            # get() copies the content without loading it
+            tree['Content'] = index.get('Content')
+            tree['Source'] = index['Source']
             have_index = True
     if not have_index:
         logger.warn("No index file in " + path)
@@ -363,7 +1092,7 @@ def build_web_tree(path, base_dir='./sources', default_template_base='base', par
             subtree['Position'] = position
             tree['Children'].append(subtree)
         else:
-            child = load_file(npath)
+            child = load_source(npath)
             child['Position'] = position
             child['Parent'] = tree
             child['URL'] = tree['URL']+child['Name']+'.html'
@@ -371,45 +1100,50 @@ def build_web_tree(path, base_dir='./sources', default_template_base='base', par
                 child['Meta']['Template'] = tree['Meta']['ChildTemplate']
             if isinstance(child['Meta']['Template'], dict):
                 child['URL'] = tree['URL']+child['Name']
-                child_copy = deep_copy(child)
+                child_copy = webnode(child)
                 for (subpage, tpl) in child['Meta']['Template'].items():
-                    pg = deep_copy(child_copy)
-                    pg['Name'] = subpage.lower()
                     if tpl == '':
-                        pg['Meta']['Template'] = tree['Meta']['ChildTemplate']
-                        if isinstance(pg['Meta']['Template'],dict):
-                            pg['Meta']['Template'] = pg['Meta']['Template'][subpage]
-                            if pg['Meta']['Template'] == '':
-                                pg['Meta']['Template'] = tpl_base+'.tpl'
-                    else:
-                        pg['Meta']['Template'] = tpl
-                    pg['Parent'] = child
+                        tpl = tree['Meta']['ChildTemplate']
+                        if isinstance(tpl,dict):
+                            tpl = tpl[subpage]
+                            if tpl == '':
+                                tpl = tpl_base+'.tpl'
+                    meta = dict(child_copy['Meta'])
+                    meta['Template'] = tpl
+                    pg = webnode_view(child_copy, {
+                        'Name': subpage.lower(),
+                        'Meta': meta,
+                        'Parent': child,
+                        'Children': webnode_list([])
+                    })
                     pg['OutFile'] = pg['Name']+'.html'
                     pg['URL'] = child['URL']+'/'+pg['OutFile']
-                    pg['Children'] = webnode_list([])
                     child['Children'].append(pg)
                 child['Virtual'] = True
             tree['Children'].append(child)
     if 'GroupBy' in tree['Meta']:
         subtrees = []
         index_page = None
+        children_sorted = False
         for (name, grouping) in tree['Meta']['GroupBy'].items():
-            group_subtree = {
+            group_subtree = webnode({
                 'Name': name.lower(),
                 'URL': tree['URL']+name.lower()+'/',
                 "Type": "index",
                 "Parent": tree,
                 "Children": webnode_list([]),
-                "Content": tree["Content"],
+                "Content": tree.get("Content"),
                 "Format": tree["Format"],
                 "Meta": tree["Meta"],
                 "Virtual": True,
-                "OutFile": "index.html"
-            }
-            page_template = {
+                "OutFile": "index.html",
+                "Source": tree["Source"]
+            })
+            page_template = webnode({
                 "Parent": group_subtree,
                 "Children": webnode_list([]),
-                "Content": tree["Content"],
+                "Content": tree.get("Content"),
+                "Source": tree["Source"],
                 "Format": tree["Format"],
                 "Meta": tree["Meta"],
                 "Group": {
@@ -423,19 +1157,18 @@ def build_web_tree(path, base_dir='./sources', default_template_base='base', par
                     "PrevURL": "",
                     "NextURL": ""
                 }
-            }
-            all = deep_copy(page_template)
+            })
+            all = group_page(page_template)
             all["Name"] = "all"
             all["URL"] = tree['URL']+name.lower()+'/all.html'
             all["OutFile"] = "all.html"
             for ch in tree['Children']:
-                nch = deep_copy(ch)
-                nch['Virtual'] = True
-                all['Group']['Children'].append(nch)
+                all['Group']['Children'].append(webnode_view(ch, {'Virtual': True}))
             group_subtree['Children'].append(all)
             if grouping['Type'] == 'Size':
-                if 'SortBy' in grouping:
+                if 'SortBy' in grouping and not children_sorted:
                     tree['Children'] = sorted(tree['Children'], key=lambda x: x['Meta']['Date'], reverse=True)
+                    children_sorted = True
                 pg_size = grouping['PageSize']
                 num_pages = len(tree['Children'])/pg_size
                 if len(tree['Children']) % pg_size > 0:
@@ -444,7 +1177,7 @@ def build_web_tree(path, base_dir='./sources', default_template_base='base', par
                 page_template["Group"]["FirstURL"] = tree['URL']+name.lower()+'/1.html'
                 page_template["Group"]["LastURL"] = tree['URL']+name.lower()+'/'+str(num_pages)+'.html'
                 for pg in range(num_pages):
-                    pg_node = deep_copy(page_template)
+                    pg_node = group_page(page_template)
                     pg_node['Name'] = str(pg+1)
                     pg_node['URL'] = tree['URL']+name.lower()+'/'+str(pg+1)
                     pg_node['OutFile'] = str(pg+1)+'.html'
@@ -461,28 +1194,33 @@ def build_web_tree(path, base_dir='./sources', default_template_base='base', par
             elif grouping['Type'] == 'Attribute':
                 attr = grouping['Attribute']
                 vals = set([])
-                if 'SortBy' in grouping:
+                if 'SortBy' in grouping and not children_sorted:
                     tree['Children'] = sorted(tree['Children'], key=lambda x: x['Meta']['Date'], reverse=True)
+                    children_sorted = True
+                # Inverted index attribute value -> (virtual copies of) children
+                # having that value, in the order of tree['Children']
+                index = {}
                 for ch in tree['Children']:
                     val = resolve_attr(ch, attr)
-                    if val is not None:
-                        if isinstance(val, list):
-                            vals.update(val)
-                        else:
-                            vals.add(val)
+                    if val is None:
+                        continue
+                    if isinstance(val, list):
+                        vals.update(val)
+                    else:
+                        vals.add(val)
+                        val = [val]
+                    nch = webnode_view(ch, {'Virtual': True})
+                    for v in val:
+                        matches = index.setdefault(v, [])
+                        if len(matches) == 0 or matches[-1] is not nch:
+                            matches.append(nch)
                 for pg in vals:
-                    pg_node = deep_copy(page_template)
+                    pg_node = group_page(page_template)
                     pg_node['Group']['NoPagination'] = True
                     pg_node['Name'] = unicode(pg).lower()
                     pg_node['OutFile'] = unicode(pg).lower()+'.html'
                     pg_node['URL'] = tree['URL']+name.lower()+'/'+unicode(pg).lower()
-                    for ch in tree['Children']:
-                        val = resolve_attr(ch, attr)
-                        if val is not None:
-                            if (isinstance(val, list) and pg in val) or (val == pg):
-                                nch = deep_copy(ch)
-                                nch['Virtual'] = True
-                                pg_node['Group']['Children'].append(nch)
+                    pg_node['Group']['Children'].extend(index[pg])
                     group_subtree['Children'].append(pg_node)
             subtrees.append(group_subtree)
         tree['Group'] = {
@@ -498,8 +1236,46 @@ def meta_json_format(val, meta):
     return json.loads(val)
 
 
+# Parsed data files shared by all pages referencing them; the values must
+# be treated as read-only
+data_files = {}
+
+
+def load_data_file(key, path, loader):
+    record_dep('data', path)
+    sig = file_signature(path)
+    cached = data_files.get(key, None)
+    if cached is not None and cached[0] == sig:
+        return cached[1]
+    value = loader()
+    data_files[key] = (sig, value)
+    return value
+
+
 def meta_jsonfile_format(val, meta):
-    return json.load(open('./'+val))
+    path = './'+val
+    return load_data_file(('jsonfile', path), path, lambda: json.load(open(path)))
+
+
+def read_csv(path, options):
+    headers = options.get('headers', None)
+    csv = []
+    startline = int(options['startline'])
+    with open(path) as f:
+        for l in f:
+            l = unicode(l, encoding='utf-8').strip()
+            if startline > 1:
+                startline = startline - 1
+                continue
+            raw_row = l.split(options['separator'])
+            if headers is None:
+                csv.append(raw_row)
+            else:
+                row = {}
+                for n in range(min(len(raw_row), len(headers))):
+                    row[headers[n]] = raw_row[n]
+                csv.append(row)
+    return csv
 
 
 def meta_csv_format(val, meta):
@@ -508,23 +1284,8 @@ def meta_csv_format(val, meta):
         'startline': '1'
     }
     options.update(json.loads(val))
-    headers = options.get('headers', None)
-    csv = []
-    startline = int(options['startline'])
-    for l in open('./'+options['file']).readlines():
-        l = unicode(l, encoding='utf-8').strip()
-        if startline > 1:
-            startline = startline - 1
-            continue
-        raw_row = l.split(options['separator'])
-        if headers is None:
-            csv.append(raw_row)
-        else:
-            row = {}
-            for n in range(min(len(raw_row), len(headers))):
-                row[headers[n]] = raw_row[n]
-            csv.append(row)
-    return csv
+    path = './'+options['file']
+    return load_data_file(('csv', json.dumps(options, sort_keys=True)), path, lambda: read_csv(path, options))
 
 
 def meta_jinja_format(val,meta):
@@ -532,11 +1293,12 @@ def meta_jinja_format(val,meta):
 
 def meta_dir_format(val,meta):
     if os.path.isdir('./'+val):
-        return os.listdir('./'+val)
+        path = './'+val
+        return load_data_file(('dir', val), path, lambda: os.listdir(path))
     else:
         pattern = os.path.basename(val)
         dirname = './'+os.path.dirname(val)
-        return [f for f in os.listdir(dirname) if re.match(pattern,f)]
+        return load_data_file(('dir', val), dirname, lambda: [f for f in os.listdir(dirname) if re.match(pattern,f)])
 
 def meta_str_format(val,meta):
     return val
@@ -550,7 +1312,12 @@ META_FORMATS = {
     'str':meta_str_format
 }
 
+bib_cache = {
+    'dir': None
+}
+
 try:
+    import pybtex
     from pybtex.database.input.bibtex import Parser as BibParser
     P = BibParser()
     P.macros['true']=True
@@ -560,19 +1327,47 @@ try:
         ret = t.replace('{','').replace('}','').replace("\\'\\i",u'í').replace('\\vc',u'č').replace('---','&mdash;').replace('--','&ndash;')
         return ret.replace('\\textendash','&ndash;')
 
-    def meta_bib_format(val,meta):
+    # The list of publications together with groupings by year, type and
+    # author (last name), each keeping the order of the .bib file
+    class bib_list(list):
+        def __init__(self, pubs):
+            super(bib_list, self).__init__(pubs)
+            self.by_year, self.by_type, self.by_author = {}, {}, {}
+            for pub in self:
+                self.by_year.setdefault(pub['year'], []).append(pub)
+                self.by_type.setdefault(pub['type'], []).append(pub)
+                for a in pub['author']:
+                    pubs = self.by_author.setdefault(a['last'], [])
+                    if len(pubs) == 0 or pubs[-1] is not pub:
+                        pubs.append(pub)
+            self.years = sorted(self.by_year.keys(), reverse=True)
+
+    # The expensive part (parsing, fromBTeX conversion) is cached; the dicts
+    # are rebuilt in the same order as they were originally built so that
+    # they iterate (and print) the same way
+    def parse_bib(val):
         bib = P.parse_file(val)
-        ret = []
+        entries = []
         for entry in bib.entries.values():
-            pub = {'type':entry.type}
-            pub.update(entry.fields)
-            authors = entry.persons.get('author',[])
-            editors = entry.persons.get('editor',[])
-            pub['author'] = [ {"first":fromBTeX(a.first()[0]), "last":fromBTeX(a.last()[0])} for a in authors ]
-            pub['editor'] = [ {"first":fromBTeX(a.first()[0]), "last":fromBTeX(a.last()[0])} for a in editors ]
-            for k in CONVERT_KEYS:
-                if k in pub:
-                    pub[k] = fromBTeX(pub[k])
+            fields = [(k, fromBTeX(v) if k in CONVERT_KEYS else v) for (k, v) in entry.fields.items()]
+            authors = [(fromBTeX(a.first()[0]), fromBTeX(a.last()[0])) for a in entry.persons.get('author',[])]
+            editors = [(fromBTeX(a.first()[0]), fromBTeX(a.last()[0])) for a in entry.persons.get('editor',[])]
+            entries.append((entry.type, fields, authors, editors))
+        return entries
+
+    # Cached entries depend on the conversion code as well as on pybtex, bump
+    # BIB_FORMAT when the layout of the entries changes
+    BIB_FORMAT = 1
+    BIB_VERSION = sha.sha(json.dumps([pybtex.__version__, BIB_FORMAT, CONVERT_KEYS])+''.join(
+        [f.func_code.co_code+repr(f.func_code.co_consts) for f in [fromBTeX, parse_bib]])).hexdigest()
+
+    def make_pubs(entries):
+        ret = []
+        for (type, fields, authors, editors) in entries:
+            pub = {'type':type}
+            pub.update(fields)
+            pub['author'] = [ {"first":first, "last":last} for (first, last) in authors ]
+            pub['editor'] = [ {"first":first, "last":last} for (first, last) in editors ]
             if 'year' not in pub:
                 pub['year'] = float('inf')
             else:
@@ -580,6 +1375,20 @@ try:
             ret.append(pub)
         return ret
 
+    def read_bib(val):
+        if bib_cache['dir'] is None:
+            return bib_list(make_pubs(parse_bib(val)))
+        key = sha.sha(BIB_VERSION+hash(val)).hexdigest()
+        data = cache_get(bib_cache['dir'], key)
+        if data is not None:
+            return bib_list(make_pubs(cPickle.loads(data)))
+        entries = parse_bib(val)
+        cache_put(bib_cache['dir'], key, cPickle.dumps(entries, cPickle.HIGHEST_PROTOCOL))
+        return bib_list(make_pubs(entries))
+
+    def meta_bib_format(val,meta):
+        return load_data_file(('bib', val), val, lambda: read_bib(val))
+
     META_FORMATS['bib'] = meta_bib_format
 
 except:
@@ -589,32 +1398,69 @@ try:
     from dateutil import parser as dateparser
     def parse_date(val):
         return dateparser.parse(val)
+    # Without digits, dateutil can only parse month and weekday names
+    DATE_WORDS = set([name.lower() for names in dateparser.parserinfo.MONTHS+dateparser.parserinfo.WEEKDAYS for name in names])
 except:
     def parse_date(val):
         raise BaseException("Date Parser unavailable")
+    DATE_WORDS = None
 
-def guess_meta_format(val,meta):
-    try:
-        return int(val)
-    except:
-        pass
+DIGIT_PATTERN = re.compile('\d', re.UNICODE)
+NON_ASCII_PATTERN = re.compile(u'[^\x00-\x7f]')
+WORD_PATTERN = re.compile('[^\W\d_]+', re.UNICODE)
+FLOAT_WORD_PATTERN = re.compile('inf|nan', re.IGNORECASE)
+TRUE_PATTERN = re.compile('True', re.IGNORECASE)
+FALSE_PATTERN = re.compile('False', re.IGNORECASE)
+AS_IS = object()
+guessed_meta = {}
 
-    try:
-        return float(val)
-    except:
-        pass
 
-    try:
-        return parse_date(val)
-    except:
-        pass
+def maybe_date(val):
+    if DATE_WORDS is None:
+        return False
+    if NON_ASCII_PATTERN.search(val) and any([c.isdigit() for c in val]):
+        return True
+    for word in WORD_PATTERN.findall(val.lower()):
+        if word in DATE_WORDS:
+            return True
+    return False
+
+
+def guess_value(val):
+    has_digit = DIGIT_PATTERN.search(val) is not None
+    if has_digit:
+        try:
+            return int(val)
+        except:
+            pass
+
+    if has_digit or FLOAT_WORD_PATTERN.search(val):
+        try:
+            return float(val)
+        except:
+            pass
+
+    if has_digit or maybe_date(val):
+        try:
+            return parse_date(val)
+        except:
+            pass
 
-    if re.match('True',val,re.IGNORECASE):
+    if TRUE_PATTERN.match(val):
         return True
-    if re.match('False',val,re.IGNORECASE):
+    if FALSE_PATTERN.match(val):
         return False
 
-    return val
+    return AS_IS
+
+def guess_meta_format(val,meta):
+    if val not in guessed_meta:
+        if len(guessed_meta) > 100000:
+            guessed_meta.clear()
+        guessed_meta[val] = guess_value(val)
+    if guessed_meta[val] is AS_IS:
+        return val
+    return guessed_meta[val]
 
 def add_key_to_meta(key,format,val,meta):
     if key is None:
@@ -638,46 +1484,95 @@ META_PATTERN=re.compile("""
     :(?P<val>.*)                        # First line of value
     """,re.VERBOSE
 )
+class lazy_content(object):
+    def __init__(self, file, offset, prefix=u''):
+        self.file = file
+        self.offset = offset
+        self.prefix = prefix
+
+    def load(self):
+        with open(self.file, 'rb') as f:
+            f.seek(self.offset)
+            return self.prefix + unicode(f.read(), encoding='utf-8', errors='ignore')
+
+
 def load_file(file):
     format = get_extension(file)
     meta={}
     current_key, current_val, current_format = None, '', None
-    content, content_before_meta = unicode(""), unicode("")
+    content_before_meta = []
     section = "before_meta"
-    for l in open(file).readlines():
-        l = unicode(l,encoding='utf-8',errors='ignore')
-        if section == "content":
-            content = content + l
-        elif section == "meta":
-            if SECTION_DELIMITER_PATTERN.match(l):
-                add_key_to_meta(current_key,current_format,current_val,meta)
-                section = "content"
-            else:
-                m = META_PATTERN.match(l)
-                if m:
+    offset = 0
+    parent_deps, jinja_env.deps = jinja_env.deps, new_deps()
+    with open(file, 'rb') as f:
+        for l in iter(f.readline, ''):
+            offset = offset + len(l)
+            l = unicode(l,encoding='utf-8',errors='ignore')
+            if section == "meta":
+                if SECTION_DELIMITER_PATTERN.match(l):
                     add_key_to_meta(current_key,current_format,current_val,meta)
-                    current_key=m.group('key')
-                    current_format=m.group('format')
-                    current_val = m.group('val').strip()
+                    section = "content"
+                    break
                 else:
-                    current_val = current_val + l
-        elif SECTION_DELIMITER_PATTERN.match(l):
-            section = "meta"
-        else:
-            content_before_meta = content_before_meta + l
-    if len(meta) == 0:
-        content = content_before_meta + content
+                    m = META_PATTERN.match(l)
+                    if m:
+                        add_key_to_meta(current_key,current_format,current_val,meta)
+                        current_key=m.group('key')
+                        current_format=m.group('format')
+                        current_val = m.group('val').strip()
+                    else:
+                        current_val = current_val + l
+            elif SECTION_DELIMITER_PATTERN.match(l):
+                section = "meta"
+            else:
+                content_before_meta.append(l)
+    # The content is only read when the page is rendered (see webnode)
+    if section == "before_meta":
+        content = lazy_content(file, 0)
+    elif len(meta) == 0:
+        content = lazy_content(file, offset, u''.join(content_before_meta))
+    else:
+        content = lazy_content(file, offset)
+    source_deps[file], jinja_env.deps = jinja_env.deps, parent_deps
     bname = strip_extension(os.path.basename(file))
     if 'ShortName' not in meta and bname != 'index':
         meta['ShortName'] = bname.capitalize()
-    return {
+    return webnode({
         'Name': bname,
         'OutFile': bname+'.html',
         'Meta': meta,
         'Content': content,
         'Format': format,
-        'Children': webnode_list([])
-    }
+        'Children': webnode_list([]),
+        'Source': file
+    })
+
+
+parsed_files = {}
+
+
+def source_signature(file):
+    sig = [file_signature(file)]
+    deps = source_deps.get(file, None)
+    if deps is not None:
+        for path in sorted(deps['data'] | deps['templates']):
+            sig.append(file_signature(path))
+        # Meta may embed asset urls, resolving them again marks the assets
+        # for copying when the cached parse is reused
+        for asset in sorted(deps['assets']):
+            sig.append(get_asset_url(jinja_env, asset))
+    return sig
+
+
+def load_source(file):
+    cached = parsed_files.get(file, None)
+    if cached is None or cached[0] != source_signature(file):
+        node = load_file(file)
+        cached = parsed_files[file] = (source_signature(file), node)
+    node = webnode(cached[1])
+    node['Meta'] = dict(node['Meta'])
+    node['Children'] = webnode_list([])
+    return node
 
 
 def content_asis_format(content, context):
@@ -695,11 +1590,35 @@ CONTENT_FORMATS = {
     'tpl': content_jinja_format
 }
 
+markdown_cache = {
+    'dir': None,
+    'max_size': 0
+}
+
 try:
     import markdown
 
+    try:
+        import pygments
+        MARKDOWN_VERSIONS = [markdown.__version__, pygments.__version__]
+    except ImportError:
+        MARKDOWN_VERSIONS = [markdown.__version__, None]
+
+    def render_markdown(text, extensions=[]):
+        if markdown_cache['dir'] is None:
+            return markdown.markdown(text, extensions=extensions)
+        h = sha.sha(json.dumps([MARKDOWN_VERSIONS, extensions]))
+        h.update(text.encode('utf-8'))
+        key = h.hexdigest()
+        html = cache_get(markdown_cache['dir'], key)
+        if html is not None:
+            return unicode(html, encoding='utf-8')
+        html = markdown.markdown(text, extensions=extensions)
+        cache_put(markdown_cache['dir'], key, html.encode('utf-8'))
+        return html
+
     def content_md_format(content, context):
-        return markdown.markdown(content, extensions=[
+        return render_markdown(content, extensions=[
             'markdown.extensions.codehilite',
             'markdown.extensions.fenced_code',
             'markdown.extensions.tables',
@@ -711,7 +1630,7 @@ try:
         return content_md_format(content_jinja_format(content, context), context)
 
     def meta_md_format(val, meta):
-        return markdown.markdown(val)
+        return render_markdown(val)
 
     content_md_format.scan_assets = True
     meta_md_format.scan_assets = True
@@ -725,62 +1644,245 @@ except:
 
 
 def render_node(node, global_ctx):
+    # Either rewrite the asset urls of the final page in a single pass or
+    # only those in content formats which ask for it (e.g. Markdown)
+    rewrite_output = jinja_env.config.get('rewrite_asset_urls', False)
+    minify_output = jinja_env.config.get('minify_html', False) and get_extension(node['OutFile']) in ['html', 'htm']
     node_context = {}
     node_context.update(global_ctx)
     node_context.update(node)
+    node_context['Content'] = node['Content']
     formatter = CONTENT_FORMATS.get(node['Format'], content_asis_format)
     try:
-        formated_content = formatter(node['Content'], node_context)
-        if hasattr(formatter, 'scan_assets'):
+        with timer('format', node['Format']):
+            formated_content = formatter(node_context['Content'], node_context)
+        if hasattr(formatter, 'scan_assets') and not rewrite_output:
             formated_content = scan_html_for_assets(jinja_env, formated_content)
     except Exception as e:
         logger.error("Unable to format content of " + node['Name'] + " Exception:" + str(e))
-        logger.warn("Offending content:" + node['Content'])
-        formated_content = node['Content']
+        logger.warn("Offending content:" + node_context['Content'])
+        formated_content = node_context['Content']
+    if search_index['config'] is not None and is_searchable(node):
+        search_pages[node['URL']] = index_page(node, formated_content)
     if node['Meta']['Template'] == 'None':
-        return formated_content
+        output = [formated_content]
     else:
         node_context['Content'] = formated_content
-        return render_template(node['Meta']['Template'], node_context)
+        output = stream_template(node['Meta']['Template'], node_context)
+    if rewrite_output:
+        output = [scan_html_for_assets(jinja_env, u''.join(output))]
+    if minify_output:
+        output = [minify_html(u''.join(output))]
+    return output
+
+TREE_SIGNATURE_KEYS = ['Name', 'URL', 'OutFile', 'Type', 'Format', 'Position', 'Virtual', 'Source', 'Meta']
+
+
+def tree_signature(tree):
+    h = sha.sha()
+
+    def walk(node):
+        h.update(json.dumps([node.get(k, None) for k in TREE_SIGNATURE_KEYS], sort_keys=True, default=repr))
+        for child in node['Children']:
+            walk(child)
+        for child in node.get('Group', {}).get('GenerateChildren', []):
+            walk(child)
+    walk(tree)
+    return h.hexdigest()
 
-def process_tree(tree,global_ctx={},dest_path='./website',dry_run=False):
-    ctx = {}
-    ctx.update(global_ctx)
-    ctx.update(tree)
-    index_path = os.path.join(dest_path,tree['OutFile'])
+
+def build_signature(cfg, args, tree, code_files):
+    h = sha.sha()
+    h.update(json.dumps(cfg, sort_keys=True, default=repr))
+    h.update(json.dumps([args.sources, args.templates]+[file_signature(f) for f in code_files]))
+    h.update(json.dumps(list_files(args.templates)))
+    h.update(tree_signature(tree))
+    return h.hexdigest()
+
+
+def load_manifest(path):
+    try:
+        return json.load(open(path))
+    except (IOError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    mkdir_p(os.path.dirname(path))
+    json.dump(manifest, open(path, 'w'))
+
+
+def asset_hashes(deps):
+    assets = {}
+    for asset in deps['assets']:
+        assets[asset] = jinja_env.assets.get(asset, {}).get('hash', None)
+    return assets
+
+
+def manifest_entry(deps):
+    inputs = deps['templates'] | deps['data']
+    for src in deps['sources']:
+        inputs.add(src)
+        inputs.update(source_deps[src]['templates'])
+        inputs.update(source_deps[src]['data'])
+    return {
+        'inputs': dict([(path, file_signature(path)) for path in inputs]),
+        'assets': asset_hashes(deps)
+    }
+
+
+def merge_assets(env, assets):
+    for (asset, h) in assets.items():
+        if asset not in env.assets:
+            env.missing_assets[asset] = True
+        else:
+            env.assets[asset]['hash'] = h
+            env.assets[asset]['copy'] = True
+
+
+def is_up_to_date(out_path, entry):
+    if entry is None or not os.path.exists(out_path):
+        return False
+    for (path, sig) in entry['inputs'].items():
+        if file_signature(path) != sig:
+            return False
+    for (asset, h) in entry['assets'].items():
+        get_asset_url(jinja_env, asset)
+        if jinja_env.assets.get(asset, {}).get('hash', None) != h:
+            return False
+    return True
+
+
+def walk_tree(tree, dest_path):
     if not tree.get('Virtual',False):
-        index = render_node(tree,ctx)
-    if not dry_run and not tree.get('Virtual',False):
-        if not os.path.isdir(dest_path):
-            mkdir_p(dest_path)
-        logger.info("Writing "+index_path)
-        open(index_path,'w').write(index.encode('utf-8'))
+        yield (tree,dest_path)
     for child in tree['Children']:
         if child.get("Type","page") == 'index':
             ch_path = os.path.join(dest_path,child['Name'])
         else:
             ch_path = dest_path
-        process_tree(child,global_ctx,ch_path,dry_run)
+        for item in walk_tree(child,ch_path):
+            yield item
     if 'Group' in tree and 'GenerateChildren' in tree['Group']:
         for child in tree['Group']['GenerateChildren']:
-            process_tree(child,global_ctx,dest_path,dry_run)
+            for item in walk_tree(child,dest_path):
+                yield item
+
+
+def process_node(node,global_ctx,dest_path,dry_run=False,manifest=None):
+    ctx = {}
+    ctx.update(global_ctx)
+    ctx.update(node)
+    index_path = os.path.join(dest_path,node['OutFile'])
+    if manifest is not None:
+        previous = manifest['previous'].get(index_path,None)
+        if is_up_to_date(index_path,previous):
+            logger.info("Up to date "+index_path)
+            if not dry_run:
+                output_files[index_path] = 'unchanged'
+                search_pages[node['URL']] = None
+            return previous
+    if not dry_run and not os.path.isdir(dest_path):
+        mkdir_p(dest_path)
+    jinja_env.deps = new_deps()
+    try:
+        # The page is rendered while it is written, dependencies are only
+        # complete once all of it has been consumed
+        with timer('node', index_path):
+            index = render_node(node,ctx)
+            if dry_run:
+                for chunk in index:
+                    pass
+            else:
+                logger.info("Writing "+index_path)
+                output_files[index_path] = write_atomic(index_path,index)
+        if manifest is not None:
+            entry = manifest_entry(jinja_env.deps)
+        else:
+            entry = {'assets': asset_hashes(jinja_env.deps)}
+    finally:
+        jinja_env.deps = None
+    return entry
+
+
+render_jobs = []
+
+
+def render_job(job):
+    fingerprints['updated'] = {}
+    stats.clear()
+    timings['events'] = []
+    output_files.clear()
+    search_pages.clear()
+    try:
+        entry = process_node(*render_jobs[job])
+    except SystemExit:
+        return None
+    return (entry, fingerprints['updated'], dict(stats), timings['events'], dict(output_files), dict(search_pages))
+
+
+def process_tree(tree,global_ctx={},dest_path='./website',dry_run=False,manifest=None,jobs=1):
+    nodes = list(walk_tree(tree,dest_path))
+    out_paths = collections.Counter([os.path.join(path,node['OutFile']) for (node,path) in nodes])
+    duplicates = set([out_path for (out_path,count) in out_paths.items() if count > 1])
+    for out_path in sorted(duplicates):
+        logger.error("'"+out_path+"' is written by several pages, the last one wins")
+    if jobs > 1:
+        # Workers are forked and inherit the tree and the jinja environment,
+        # only the list of resolved assets travels back to the parent.
+        # Pages sharing an output are rendered in the parent in tree order,
+        # like in a serial build.
+        import multiprocessing
+        pooled = [i for (i,(node,path)) in enumerate(nodes) if os.path.join(path,node['OutFile']) not in duplicates]
+        render_jobs[:] = [(nodes[i][0],global_ctx,nodes[i][1],dry_run,manifest) for i in pooled]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(render_job,range(len(render_jobs)),chunksize=max(1,len(render_jobs)/(4*jobs)))
+        finally:
+            pool.close()
+            pool.join()
+            render_jobs[:] = []
+        if None in results:
+            logger.critical("Rendering failed, giving up.")
+            exit(1)
+        entries = [None]*len(nodes)
+        for (i,(entry,updated,job_stats,events,outputs,pages)) in zip(pooled,results):
+            entries[i] = entry
+            fingerprints['cache'].update(updated)
+            stats.update(job_stats)
+            timings['events'].extend(events)
+            output_files.update(outputs)
+            search_pages.update(pages)
+        for (i,(node,path)) in enumerate(nodes):
+            if entries[i] is None:
+                entries[i] = process_node(node,global_ctx,path,dry_run,manifest)
+    else:
+        entries = [process_node(node,global_ctx,path,dry_run,manifest) for (node,path) in nodes]
+    for ((node,path),entry) in zip(nodes,entries):
+        merge_assets(jinja_env,entry['assets'])
+        if manifest is not None:
+            manifest['outputs'][os.path.join(path,node['OutFile'])] = entry
 
 
 def scan_assets(install_list):
     asset_list = {}
+    # Directory listings shared by all items installing from the same tree
+    listings = {}
     for item in install_list:
-        pattern = item.get('pattern','.*')
+        pattern = re.compile(item.get('pattern','.*'))
         recursive = ('recursive' in item and item['recursive']=="true")
         transform_src_pat, transform_dest_repl = item.get('transform',':').split(':')
+        transform_src_pat = re.compile(transform_src_pat)
         filters = item.get('filters',[])
         copy = ('force' in item and item['force'] == "true")
-        item_list = ls(item['src'],pattern,recursive)
+        item_list = ls(item['src'],pattern,recursive,listings)
         rel_start=len(item['src'])
         for i in item_list:
-            asset_key = re.sub(transform_src_pat, transform_dest_repl, '/'+item['dst']+i[rel_start:])
+            asset_key = transform_src_pat.sub(transform_dest_repl, '/'+item['dst']+i[rel_start:])
             asset_list[asset_key]= {
                 'src':i,
                 'copy':copy,
+                'force':copy,
                 'hash':None,
                 'filters':filters
             }
@@ -788,9 +1890,293 @@ def scan_assets(install_list):
     logger.debug(asset_list)
     return asset_list
 
+def reset_assets(assets):
+    for data in assets.values():
+        data['hash'] = None
+        data['copy'] = data['force']
+
+
+def install_asset(job):
+    (src, dest, filters) = job
+    logger.info("Copying '"+src+''" to '"+dest+"'")
+    output_files[dest] = cp(src, dest, create_parents=True, filters=filters)
+
+
+def install_assets(assets, dest_dir, state_path, jobs=1):
+    previous = load_manifest(state_path)
+    state = {}
+    pooled, serial = [], []
+    for (asset, data) in assets.items():
+        if not data['copy']:
+            logger.info("Skipping '"+data['src']+"'")
+            continue
+        dest = dest_dir+'/'+asset
+        source = {
+            'hash': data['hash'] or fingerprint(data['src']),
+            'filters': data['filters']
+        }
+        state[dest] = {'source': source}
+        old = previous.get(dest, {})
+        # Filtered assets also depend on the files the filters read, assets
+        # whose filters read unknown files are always installed
+        if old.get('source', None) == source and old.get('dest', None) == file_signature(dest) and signatures_match(old.get('deps', None)):
+            logger.info("Unchanged '"+dest+"'")
+            output_files[dest] = 'unchanged'
+            state[dest]['deps'] = old['deps']
+            continue
+        if any([f in INSTALL_FILTERS for f in data['filters']]):
+            serial.append((data['src'], dest, data['filters']))
+        else:
+            pooled.append((data['src'], dest, data['filters']))
+    if jobs > 1 and len(pooled) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(jobs)
+        try:
+            pool.map(install_asset, pooled)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        serial = pooled + serial
+    # In-process filters hold the interpreter lock and gain nothing from threads
+    for job in serial:
+        install_asset(job)
+    for dest in state:
+        state[dest]['dest'] = file_signature(dest)
+        if 'deps' not in state[dest]:
+            state[dest]['deps'] = filter_deps.pop(dest, None)
+    save_manifest(state_path, state)
+
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_EXTENSIONS = ['html', 'htm', 'css', 'js', 'svg', 'json', 'xml', 'txt']
+
+
+def gzip_compress(data):
+    buf = StringIO()
+    # No name and timestamp in the header, so unchanged inputs give identical output
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def brotli_compress(data):
+    return brotli.compress(data, quality=11)
+
+
+COMPRESSORS = {
+    'gz': gzip_compress,
+    'br': brotli_compress
+}
+
+
+def compress_output(job):
+    (path, formats) = job
+    logger.info("Compressing '"+path+"'")
+    data = open(path, 'rb').read()
+    return dict([(path+'.'+fmt, write_atomic(path+'.'+fmt, [COMPRESSORS[fmt](data)])) for fmt in formats])
+
+
+def compress_outputs(files, state_path, formats, min_size=1024, extensions=COMPRESS_EXTENSIONS, jobs=1):
+    if 'br' in formats and brotli is None:
+        logger.warn("Brotli is not available, skipping .br files")
+        formats = [fmt for fmt in formats if fmt != 'br']
+    previous = load_manifest(state_path)
+    state = {}
+    pending = []
+    for path in sorted(files):
+        old = previous.get(path, {'signature': None, 'hash': None, 'formats': []})
+        signature = file_signature(path)
+        if signature is None or signature[0] < min_size or get_extension(path) not in extensions:
+            path_formats = []
+        else:
+            path_formats = formats
+        # Remove the files compressed by a previous build which are no longer wanted
+        for fmt in old['formats']:
+            if fmt not in path_formats and os.path.exists(path+'.'+fmt):
+                os.remove(path+'.'+fmt)
+        if len(path_formats) == 0:
+            continue
+        if old['signature'] == signature:
+            h = old['hash']
+        else:
+            h = hash(path)
+        state[path] = {'signature': signature, 'hash': h, 'formats': path_formats}
+        if old['hash'] == h and all([os.path.exists(path+'.'+fmt) for fmt in path_formats]):
+            for fmt in path_formats:
+                output_files[path+'.'+fmt] = 'unchanged'
+        else:
+            pending.append((path, path_formats))
+    if jobs > 1 and len(pending) > 1:
+        # zlib and brotli release the interpreter lock while compressing
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(compress_output, pending)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [compress_output(job) for job in pending]
+    for result in results:
+        output_files.update(result)
+    save_manifest(state_path, state)
+
+
+SEARCH_DEFAULTS = {
+    'dir': 'search',
+    'prefix_length': 2,
+    'min_length': 2,
+    'stop_words': ['a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'in', 'is', 'it',
+                   'its', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'were', 'will', 'with']
+}
+
+# Terms in the title count as many times as this
+SEARCH_TITLE_WEIGHT = 10
+
+search_index = {
+    'config': None
+}
+
+# Pages rendered by the current build, url -> title and terms, or None for
+# pages which were up to date and keep their previous terms
+search_pages = {}
+
+SEARCH_SKIP_PATTERN = re.compile(r'<(script|style)\b[^>]*>[\s\S]*?</\1\s*>|<[^>]*>', re.IGNORECASE)
+SEARCH_TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+SEARCH_SHARD_PATTERN = re.compile(r'[^a-z0-9]')
+
+
+def is_searchable(node):
+    # Group pages only list other pages
+    if 'Group' in node and 'GenerateChildren' not in node['Group']:
+        return False
+    return node['Meta'].get('Search', True) is not False
+
+
+def search_terms(text, terms, weight=1):
+    cfg = search_index['config']
+    for term in SEARCH_TERM_PATTERN.findall(text.lower()):
+        if len(term) >= cfg['min_length'] and term not in cfg['stop_words']:
+            terms[term] = terms.get(term, 0) + weight
+
+
+def index_page(node, content):
+    title = node['Meta'].get('Title', node['Name'])
+    if not isinstance(title, basestring):
+        title = unicode(title)
+    if not isinstance(content, unicode):
+        content = unicode(content, encoding='utf-8', errors='replace')
+    terms = {}
+    search_terms(HTMLParser().unescape(SEARCH_SKIP_PATTERN.sub(' ', content)), terms)
+    search_terms(title, terms, weight=SEARCH_TITLE_WEIGHT)
+    return {'title': title, 'terms': terms}
+
+
+def search_shard(term):
+    return SEARCH_SHARD_PATTERN.sub('_', term[:search_index['config']['prefix_length']])
+
+
+def update_search_index(website, state_path):
+    cfg = search_index['config']
+    state = load_manifest(state_path)
+    if state.get('config', None) != cfg or state.get('website', None) != website:
+        state = {'next_id': 0, 'pages': {}}
+    search_dir = os.path.join(website, cfg['dir'])
+    # Only shards containing terms of added, changed or removed pages are rebuilt
+    affected = set()
+    pages = {}
+    # New pages are numbered in url order, so ids do not depend on --jobs
+    for (url, page) in sorted(search_pages.items()):
+        old = state['pages'].get(url, None)
+        if page is None:
+            if old is not None:
+                pages[url] = old
+            continue
+        if old is None:
+            page['id'] = state['next_id']
+            state['next_id'] += 1
+        else:
+            page['id'] = old['id']
+            if old['terms'] != page['terms']:
+                affected.update([search_shard(term) for term in old['terms']])
+        if old is None or old['terms'] != page['terms']:
+            affected.update([search_shard(term) for term in page['terms']])
+        pages[url] = page
+    for (url, old) in state['pages'].items():
+        if url not in pages:
+            affected.update([search_shard(term) for term in old['terms']])
+    shards = {}
+    for page in pages.values():
+        for (term, count) in page['terms'].items():
+            shards.setdefault(search_shard(term), {}).setdefault(term, []).append([page['id'], count])
+    mkdir_p(search_dir)
+    for name in set(shards.keys()) | affected:
+        path = os.path.join(search_dir, name+'.json')
+        if name not in shards:
+            if os.path.exists(path):
+                os.remove(path)
+        elif name in affected or not os.path.exists(path):
+            for postings in shards[name].values():
+                postings.sort()
+            output_files[path] = write_atomic(path, [json.dumps(shards[name], sort_keys=True, separators=(',', ':'))])
+        else:
+            output_files[path] = 'unchanged'
+    index = {
+        'prefix_length': cfg['prefix_length'],
+        'shards': sorted(shards.keys()),
+        'pages': dict([(page['id'], [page['title'], url]) for (url, page) in pages.items()])
+    }
+    path = os.path.join(search_dir, 'index.json')
+    output_files[path] = write_atomic(path, [json.dumps(index, sort_keys=True, separators=(',', ':'))])
+    save_manifest(state_path, {'config': cfg, 'website': website, 'next_id': state['next_id'], 'pages': pages})
+    logger.info("Search index: %d pages, %d shards, %d rebuilt", len(pages), len(shards), len(affected))
+
+
+def remove_output(path, website):
+    logger.info("Removing stale '"+path+"'")
+    os.remove(path)
+    parent = os.path.dirname(path)
+    while os.path.normpath(parent) != os.path.normpath(website):
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def record_changes(website, state_path, changes_path, prune=False):
+    previous = load_manifest(state_path)
+    if previous.get('website', None) != website:
+        previous = {'files': []}
+    files = dict([(os.path.relpath(path, website), status) for (path, status) in output_files.items()])
+    changes = {
+        'website': website,
+        'added': sorted([path for (path, status) in files.items() if status == 'added']),
+        'changed': sorted([path for (path, status) in files.items() if status == 'changed']),
+        'deleted': sorted([path for path in previous['files'] if path not in files])
+    }
+    stale = []
+    for path in changes['deleted']:
+        if not os.path.exists(os.path.join(website, path)):
+            continue
+        if prune:
+            remove_output(os.path.join(website, path), website)
+        else:
+            stale.append(path)
+    # Stale files which were not pruned are reported again by the next build
+    save_manifest(state_path, {'website': website, 'files': sorted(files.keys()+stale)})
+    save_manifest(changes_path, changes)
+    logger.info("Output: %d added, %d changed, %d deleted", len(changes['added']), len(changes['changed']), len(changes['deleted']))
+
+
 def parse_args():
   parser = argparse.ArgumentParser(description='A static website generator')
-  parser.add_argument('command', choices=['compile','serve','list-assets','list-formats'])
+  parser.add_argument('command', choices=['compile','watch','serve','list-assets','list-formats','clear-cache'])
   parser.add_argument('--verbose', '-v', action='count',help='be verbose',default=0)
   parser.add_argument('--sources', '-s', help='the directory with source files', default=None)
   parser.add_argument('--templates', '-t', help='the directory with template files',default=None)
@@ -802,12 +2188,15 @@ def parse_args():
   parser.add_argument('--profile',help='the profile to choose',default=None)
   parser.add_argument('--theme',help='use a theme',default=None)
   parser.add_argument('--skipassets',help='do not copy assets',default=False)
+  parser.add_argument('--cache',help='the directory for build caches',default=None)
+  parser.add_argument('--incremental',action='store_true',help='only re-render pages whose inputs changed since the last build')
+  parser.add_argument('--jobs','-j',type=int,help='the number of parallel jobs used to render pages and install assets',default=1)
+  parser.add_argument('--prune',action='store_true',help='remove output files which are no longer produced by the build')
+  parser.add_argument('--timings',nargs='?',const='timings.json',help='report where the build spends its time and write a Chrome trace to the given file',default=None)
 
   return parser.parse_args()
 
-def main():
-    args = parse_args()
-    logger.setLevel(logging.ERROR-args.verbose*10)
+def load_config(args):
     cfg = json.load(open(args.config))
     if args.profile is None:
         profile_name = cfg.get('default_profile',None)
@@ -831,70 +2220,330 @@ def main():
         args.website=cfg.get('website','website')
     if args.filters is None:
         args.filters=cfg.get('filters','filters')
+    if args.cache is None:
+        args.cache=cfg.get('cache','.yak-cache')
+    return cfg
+
+
+def setup_env(args, cfg):
+    timings['enabled'] = args.timings is not None
+    timings['start'] = time.time()
+    timings['events'] = []
+    jinja_env.config = cfg
+    jinja_env.filters['json']=json_filter
+    jinja_env.filters['asset']=asset_filter
+    jinja_env.filters['DOI']=doi_filter
+    jinja_env.filters['ARXIV']=arxiv_filter
+    jinja_env.filters['VIMEO']=vimeo_filter
+    jinja_env.filters['YOUTUBE']=youtube_filter
+    jinja_env.filters['split']=split_filter
+
+    code_files = [__file__]
+    try:
+        custom_filters = __import__(args.filters)
+        code_files.append(custom_filters.__file__)
+        for f_name in custom_filters.__all__:
+            logger.info("Loading filter %s",f_name)
+            jinja_env.filters[f_name] = getattr(custom_filters,f_name)
+    except Exception as ex:
+        logger.error("Could not load custom filters: %s",repr(ex))
+
+    jinja_env.tests['equalto']=equalto_test
+    jinja_env.tests['not equalto']=equalto_test
+    jinja_env.loader=jinja2.FileSystemLoader([args.templates])
+    bib_cache['dir'] = os.path.join(args.cache,'bib')
+    if cfg.get('string_template_cache_size',1000) > 0:
+        string_templates['cache'] = jinja2.utils.LRUCache(cfg.get('string_template_cache_size',1000))
+    else:
+        string_templates['cache'] = None
+    mkdir_p(os.path.join(args.cache,'jinja'))
+    jinja_env.bytecode_cache=yak_bytecode_cache(os.path.join(args.cache,'jinja'))
+    if timings['enabled']:
+        for (f_name, f) in jinja_env.filters.items():
+            # Filters stay wrapped when the config is reloaded
+            if not hasattr(f, 'timed'):
+                jinja_env.filters[f_name] = timed_filter(f_name, f)
+    clear_template_cache()
+    if 'assets' in cfg:
+        with timer('phase', 'scan_assets'):
+            jinja_env.assets = scan_assets(cfg['assets'])
+    else:
+        jinja_env.assets = {}
+    jinja_env.missing_assets={}
+    jinja_env.asset_urls={}
+    fingerprints['cache'] = load_manifest(os.path.join(args.cache,'fingerprints.json'))
+    if cfg.get('search',False):
+        search_index['config'] = dict(SEARCH_DEFAULTS)
+        if isinstance(cfg['search'],dict):
+            search_index['config'].update(cfg['search'])
+    else:
+        search_index['config'] = None
+    stop_filter_workers()
+    filter_workers['commands'] = cfg.get('filter_workers',{})
+    filter_cache['max_size'] = cfg.get('filter_cache_size',256)*1024*1024
+    if filter_cache['max_size'] > 0:
+        filter_cache['dir'] = os.path.join(args.cache,'filters')
+    else:
+        filter_cache['dir'] = None
+    markdown_cache['max_size'] = cfg.get('markdown_cache_size',256)*1024*1024
+    if markdown_cache['max_size'] > 0:
+        markdown_cache['dir'] = os.path.join(args.cache,'markdown')
+    else:
+        markdown_cache['dir'] = None
+    return code_files
 
-    if args.command == 'compile' or args.command == 'list-assets':
 
-        jinja_env.config = cfg
-        jinja_env.filters['json']=json_filter
-        jinja_env.filters['asset']=asset_filter
-        jinja_env.filters['DOI']=doi_filter
-        jinja_env.filters['ARXIV']=arxiv_filter
-        jinja_env.filters['VIMEO']=vimeo_filter
-        jinja_env.filters['YOUTUBE']=youtube_filter
-        jinja_env.filters['split']=split_filter
+def build(args, cfg, code_files, previous=None):
+    output_files.clear()
+    search_pages.clear()
+    default_template_base = strip_extension(cfg.get('default_template','base.tpl'))
+    with timer('phase', 'build_web_tree'):
+        tree = build_web_tree(args.sources,base_dir=args.sources,default_template_base=default_template_base)
 
-        try:
-            custom_filters = __import__(args.filters)
-            for f_name in custom_filters.__all__:
-                logger.info("Loading filter %s",f_name)
-                jinja_env.filters[f_name] = getattr(custom_filters,f_name)
-        except Exception as ex:
-            logger.error("Could not load custom filters: %s",repr(ex))
+    global_ctx={'type':type}
+    global_ctx['website']=tree
+    global_ctx['config']=cfg
 
-        jinja_env.tests['equalto']=equalto_test
-        jinja_env.tests['not equalto']=equalto_test
-        jinja_env.loader=jinja2.FileSystemLoader([args.templates])
-        if 'assets' in cfg:
-            jinja_env.assets = scan_assets(cfg['assets'])
+    manifest = None
+    if previous is not None:
+        manifest = {
+            'key': build_signature(cfg,args,tree,code_files),
+            'previous': {},
+            'outputs': {}
+        }
+        if previous.get('key',None) == manifest['key']:
+            manifest['previous'] = previous['outputs']
+        # Pages which are up to date are only indexed by an earlier build
+        if search_index['config'] is not None:
+            search_state = load_manifest(os.path.join(args.cache,'search.json'))
+            if search_state.get('config',None) != search_index['config'] or search_state.get('website',None) != os.path.normpath(args.website):
+                manifest['previous'] = {}
+
+    with timer('phase', 'process_tree'):
+        process_tree(tree,global_ctx,args.website,dry_run=(args.command =='list-assets'),manifest=manifest,jobs=args.jobs)
+
+    if markdown_cache['dir'] is not None:
+        prune_cache(markdown_cache['dir'],markdown_cache['max_size'])
+
+    if manifest is not None:
+        manifest = {'key':manifest['key'],'outputs':manifest['outputs']}
+        save_manifest(os.path.join(args.cache,'build.json'),manifest)
+
+    if search_index['config'] is not None and args.command != 'list-assets':
+        with timer('phase', 'update_search_index'):
+            update_search_index(os.path.normpath(args.website),os.path.join(args.cache,'search.json'))
+
+    if args.command == 'list-assets':
+        for asset,data in jinja_env.assets.items():
+            if data['copy']:
+                print(data['src'],'->',asset, data['hash'])
+        if len(jinja_env.missing_assets) > 0:
+            print("MISSING:")
+            print("\t\n".join(jinja_env.missing_assets.keys()))
+        print("FINGERPRINT CACHE:",stats['fingerprint_hits'],"hits,",stats['fingerprint_misses'],"misses")
+    else:
+        if not args.skipassets:
+            with timer('phase', 'install_assets'):
+                install_assets(jinja_env.assets,args.website,os.path.join(args.cache,'install.json'),jobs=args.jobs)
+            if filter_cache['dir'] is not None:
+                prune_cache(filter_cache['dir'],filter_cache['max_size'])
         else:
-            jinja_env.assets = {}
-        jinja_env.missing_assets={}
+            for (asset, data) in jinja_env.assets.items():
+                if data['copy'] and os.path.exists(args.website+'/'+asset):
+                    output_files[args.website+'/'+asset] = 'unchanged'
+        with timer('phase', 'compress_outputs'):
+            compress_outputs(output_files.keys(),os.path.join(args.cache,'compress.json'),cfg.get('compress',[]),min_size=cfg.get('compress_min_size',1024),extensions=cfg.get('compress_extensions',COMPRESS_EXTENSIONS),jobs=args.jobs)
+        record_changes(os.path.normpath(args.website),os.path.join(args.cache,'outputs.json'),os.path.join(args.cache,'changes.json'),prune=args.prune)
+        if len(jinja_env.missing_assets) > 0:
+            logger.error("The following assets were not found:")
+            logger.error(';'.join(jinja_env.missing_assets.keys()))
+
+    logger.info("Inline templates: %d compiled, %d reused",stats['string_template_misses'],stats['string_template_hits'])
+    logger.info("Filtered assets: %d reused from cache",stats['filter_cache_hits'])
+    sources = set([data['src'] for data in jinja_env.assets.values()])
+    save_manifest(os.path.join(args.cache,'fingerprints.json'),dict([(path,fp) for (path,fp) in fingerprints['cache'].items() if path in sources]))
+    if timings['enabled']:
+        report_timings(args.timings)
+        timings['start'] = time.time()
+        timings['events'] = []
+    return manifest
+
+
+ASSET_HASH_PATTERN = re.compile('\?[0-9a-f]{40}$')
+
+
+def serve(website, port):
+    import BaseHTTPServer
+    import SimpleHTTPServer
+    import SocketServer
+    from email.utils import parsedate_tz, mktime_tz
+
+    class website_handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_head(self):
+            path = self.translate_path(self.path)
+            if os.path.isdir(path):
+                url = self.path.split('?')[0].split('#')[0]
+                if not url.endswith('/'):
+                    self.send_response(301)
+                    self.send_header("Location", url+'/')
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return None
+                path = os.path.join(path, 'index.html')
+            if not os.path.isfile(path):
+                return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+            ctype = self.guess_type(path)
+            encoding = None
+            if 'gzip' in self.headers.get('Accept-Encoding', '') and os.path.isfile(path+'.gz'):
+                path, encoding = path+'.gz', 'gzip'
+            st = os.stat(path)
+            etag = '"%x-%x%s"' % (int(st.st_mtime), st.st_size, '-gz' if encoding else '')
+            if ASSET_HASH_PATTERN.search(self.path):
+                cache_control = 'public, max-age=31536000, immutable'
+            else:
+                cache_control = 'no-cache'
+            not_modified = False
+            if 'If-None-Match' in self.headers:
+                not_modified = etag in [t.strip() for t in self.headers['If-None-Match'].split(',')]
+            elif 'If-Modified-Since' in self.headers:
+                since = parsedate_tz(self.headers['If-Modified-Since'])
+                not_modified = since is not None and int(st.st_mtime) <= mktime_tz(since)
+            if not_modified:
+                self.send_response(304)
+            else:
+                self.send_response(200)
+                self.send_header("Content-type", ctype)
+                self.send_header("Content-Length", str(st.st_size))
+                if encoding is not None:
+                    self.send_header("Content-Encoding", encoding)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", cache_control)
+            self.end_headers()
+            if not_modified:
+                return None
+            return open(path, 'rb')
 
-        default_template_base = strip_extension(cfg.get('default_template','base.tpl'))
-        tree = build_web_tree(args.sources,base_dir=args.sources,default_template_base=default_template_base)
+    class threaded_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    os.chdir(website)
+    httpd = threaded_server(('', port), website_handler)
+    print("Serving HTTP on port", port, "...")
+    httpd.serve_forever()
 
-        global_ctx={'type':type}
-        global_ctx['website']=tree
-        global_ctx['config']=cfg
 
-        process_tree(tree,global_ctx,args.website,dry_run=(args.command =='list-assets'))
+WATCH_INTERVAL = 0.5
+WATCH_DEBOUNCE = 0.2
 
-        if args.command == 'list-assets':
-            for asset,data in jinja_env.assets.items():
-                if data['copy']:
-                    print(data['src'],'->',asset, data['hash'])
-            if len(jinja_env.missing_assets) > 0:
-                print("MISSING:")
-                print("\t\n".join(jinja_env.missing_assets.keys()))
+
+def snapshot(paths):
+    state = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for f in list_files(path):
+                state[f] = file_signature(f)
         else:
-            if not args.skipassets:
-                for (asset,data) in jinja_env.assets.items():
-                    if data['copy']:
-                        dest=args.website+'/'+asset
-                        logger.info("Copying '"+data['src']+''" to '"+dest+"'")
-                        cp(data['src'],dest,create_parents=True,filters=data['filters'])
-                    else:
-                        logger.info("Skipping '"+data['src']+"'")
-            if len(jinja_env.missing_assets) > 0:
-                logger.error("The following assets were not found:")
-                logger.error(';'.join(jinja_env.missing_assets.keys()))
+            state[path] = file_signature(path)
+    return state
+
+
+def watched_paths(args, cfg):
+    paths = set([args.config, args.sources, args.templates])
+    for item in cfg.get('assets', []):
+        paths.add(item['src'])
+    for deps in source_deps.values():
+        paths.update(deps['data'])
+    return paths
+
+
+def wait_for_changes(paths, state):
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        current = snapshot(paths)
+        if current != state:
+            break
+    # Editors often write several files (or one file several times) on save
+    while True:
+        time.sleep(WATCH_DEBOUNCE)
+        settled = snapshot(paths)
+        if settled == current:
+            break
+        current = settled
+    return set([path for path in set(state) | set(current) if state.get(path) != current.get(path)])
+
+
+def watch(defaults, args, cfg):
+    code_files = setup_env(args, cfg)
+    manifest = load_manifest(os.path.join(args.cache,'build.json'))
+    while True:
+        # Files saved while building trigger the next build
+        paths = watched_paths(args, cfg)
+        state = snapshot(paths)
+        start = time.time()
+        try:
+            manifest = build(args, cfg, code_files, manifest)
+            print("Built in %.2fs" % (time.time()-start))
+        except (Exception, SystemExit) as ex:
+            logger.error("Build failed: %s", repr(ex))
+        # Data files found by this build are watched from now on
+        new_paths = watched_paths(args, cfg) - paths
+        state.update(snapshot(new_paths))
+        changed = wait_for_changes(paths | new_paths, state)
+        logger.info("Changed: "+', '.join(sorted(changed)))
+        if os.path.abspath(args.config) in [os.path.abspath(path) for path in changed]:
+            args = copy.copy(defaults)
+            cfg = load_config(args)
+            code_files = setup_env(args, cfg)
+            # Parsed meta may depend on the config (e.g. cdn urls)
+            parsed_files.clear()
+            source_deps.clear()
+            data_files.clear()
+            continue
+        if any([path.startswith(args.templates) for path in changed]):
+            clear_template_cache()
+        if any([path.startswith(item['src']) for item in cfg.get('assets', []) for path in changed]):
+            with timer('phase', 'scan_assets'):
+                jinja_env.assets = scan_assets(cfg['assets'])
+        else:
+            reset_assets(jinja_env.assets)
+        jinja_env.missing_assets = {}
+        jinja_env.asset_urls = {}
+        stats.clear()
 
 
+def main():
+    args = parse_args()
+    logger.setLevel(logging.ERROR-args.verbose*10)
+    defaults = copy.copy(args)
+    cfg = load_config(args)
+
+    if args.command == 'compile' or args.command == 'list-assets':
+        code_files = setup_env(args, cfg)
+        previous = None
+        if args.incremental and args.command == 'compile':
+            previous = load_manifest(os.path.join(args.cache,'build.json'))
+        build(args, cfg, code_files, previous)
+        stop_filter_workers()
+
+    elif args.command == 'watch':
+        try:
+            watch(defaults, args, cfg)
+        except KeyboardInterrupt:
+            pass
+
     elif args.command == 'serve':
-        import SimpleHTTPServer
-        sys.argv=['wg.py',str(args.port)]
-        os.chdir(args.website)
-        SimpleHTTPServer.test()
+        try:
+            serve(args.website, args.port)
+        except KeyboardInterrupt:
+            pass
+
+    elif args.command == 'clear-cache':
+        if os.path.isdir(args.cache):
+            shutil.rmtree(args.cache)
 
     elif args.command == 'list-formats':
         print("Metadata Formats:", META_FORMATS.keys())
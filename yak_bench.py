@@ -0,0 +1,264 @@
+#!/usr/bin/env python2
+# -*- coding:utf-8 -*-
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import platform
+
+YAK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'yak.py')
+
+FORMATS = ['md', 'tmd', 'jinja', 'html']
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do',
+         'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua']
+
+BASE_TEMPLATE = """<html><head>
+<link href="{{ 'site.css'|asset('/css') }}">
+<script src="{{ 'site.js'|asset('/js') }}"></script>
+</head><body>
+<h1>{{ Meta.Title }}</h1>
+<ul>{% for p in Parent.Children %}<li><a href="{{ p.URL }}">{{ p.Meta.ShortName }}</a></li>{% endfor %}</ul>
+{% block content %}{{ Content }}{% endblock %}
+</body></html>
+"""
+
+INDEX_TEMPLATE = """{% extends "base.tpl" %}
+{% block content %}
+{{ Content }}
+{% if Group %}{% for ch in Group.Children %}<a href="{{ ch.URL }}">{{ ch.Meta.Title }}</a> {{ ch.Meta.Date }}
+{% endfor %}{% if not Group.NoPagination %}<a href="{{ Group.PrevURL }}">prev</a> <a href="{{ Group.NextURL }}">next</a>{% endif %}{% endif %}
+{% for ch in Children %}<a href="{{ ch.URL }}">{{ ch.Name }}</a>
+{% endfor %}
+{% endblock %}
+"""
+
+PRINT_TEMPLATE = """<html><body>{{ Content }}</body></html>
+"""
+
+
+def write(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def sentence(rnd, words):
+    return ' '.join([rnd.choice(WORDS) for i in range(words)])
+
+
+def page_content(rnd, format, paragraphs):
+    if format == 'html':
+        return '\n'.join(['<p>'+sentence(rnd, 40)+'</p>' for i in range(paragraphs)])+'\n<img src="/img/0/0.png">\n'
+    body = []
+    for i in range(paragraphs):
+        body.append('## '+sentence(rnd, 3).capitalize())
+        body.append(sentence(rnd, 40)+' *'+sentence(rnd, 2)+'* **'+sentence(rnd, 2)+'**')
+        if i % 3 == 2:
+            body.append('```python\nprint("'+sentence(rnd, 3)+'")\n```')
+    body.append('![img](/img/0/0.png)')
+    if format in ['tmd', 'jinja']:
+        body.append('{{ Meta.Title }} {% for t in Meta.Tags %}{{ t }} {% endfor %}')
+    return '\n\n'.join(body)+'\n'
+
+
+def page_meta(rnd, opts, n, multi_template):
+    meta = [
+        '-Title: Page '+str(n),
+        '-Date: %04d-%02d-%02d' % (2000+n % 20, 1+n % 12, 1+n % 28),
+        '-Tags(json): '+json.dumps(sorted(set(['tag%d' % rnd.randrange(opts.tags) for i in range(3)]))),
+        '-Weight: '+str(rnd.randrange(100)),
+        '-Draft: '+rnd.choice(['true', 'false']),
+        '-Summary(md): '+sentence(rnd, 10)
+    ]
+    if opts.data_files > 0 and n % 5 == 0:
+        meta.append('-Data(jsonfile): data/%d.json' % (n % opts.data_files))
+        meta.append('-Rows(csv): {"file":"data/%d.csv","headers":["name","value"],"startline":"2"}' % (n % opts.data_files))
+    if multi_template:
+        meta.append('-Template(json): {"web": "", "print": "print.tpl"}')
+    return '---\n'+'\n'.join(meta)+'\n---\n'
+
+
+def generate(path, opts):
+    rnd = random.Random(opts.seed)
+    config = {
+        'default_template': 'base.tpl',
+        'assets': [
+            {'src': 'assets/css', 'dst': 'css', 'pattern': '.*\\.css'},
+            {'src': 'assets/js', 'dst': 'js', 'pattern': '.*\\.js'},
+            {'src': 'assets/img', 'dst': 'img', 'recursive': 'true'}
+        ]
+    }
+    write(os.path.join(path, 'config.json'), json.dumps(config, indent=2))
+
+    write(os.path.join(path, 'templates', 'base.tpl'), BASE_TEMPLATE)
+    write(os.path.join(path, 'templates', 'base.index.tpl'), INDEX_TEMPLATE)
+    write(os.path.join(path, 'templates', 'print.tpl'), PRINT_TEMPLATE)
+
+    for i in range(opts.data_files):
+        write(os.path.join(path, 'data', '%d.json' % i), json.dumps(dict([(w, rnd.randrange(1000)) for w in WORDS])))
+        write(os.path.join(path, 'data', '%d.csv' % i), 'name,value\n'+''.join(['%s,%d\n' % (w, rnd.randrange(1000)) for w in WORDS]))
+
+    write(os.path.join(path, 'assets', 'css', 'site.css'), ''.join(['.c%d { color: #%06x; }\n' % (i, rnd.randrange(1 << 24)) for i in range(500)]))
+    write(os.path.join(path, 'assets', 'js', 'site.js'), ''.join(['function f%d() { return %d; }\n' % (i, i) for i in range(500)]))
+    for i in range(opts.assets):
+        write(os.path.join(path, 'assets', 'img', str(i % 10), '%d.png' % i), os.urandom(opts.asset_size))
+
+    # Pages are spread over top level sections, each nested `depth` levels
+    # deep; template lookup falls back to the top level section name
+    write(os.path.join(path, 'source', 'index.md'), '---\n-Title: Home\n---\n'+sentence(rnd, 50)+'\n')
+    sections = max(1, opts.sections)
+    for s in range(sections):
+        section = 's%d' % s
+        write(os.path.join(path, 'templates', section+'.tpl'), '{% extends "base.tpl" %}\n')
+        write(os.path.join(path, 'templates', section+'.index.tpl'), '{% extends "base.index.tpl" %}\n')
+        dirs = [os.path.join(path, 'source', section)]
+        for d in range(1, opts.depth):
+            dirs.append(os.path.join(dirs[-1], 'd%d' % d))
+        for (d, dir) in enumerate(dirs):
+            meta = '-Title: Section %d.%d\n' % (s, d)
+            # SortBy needs a Date on every child, only the innermost
+            # directory has no subdirectories
+            if d == len(dirs)-1:
+                groups = {
+                    'pages': {'Type': 'Size', 'PageSize': opts.page_size, 'SortBy': 'Date'},
+                    'tags': {'Type': 'Attribute', 'Attribute': 'Meta.Tags', 'SortBy': 'Date'}
+                }
+                meta += '-GroupBy(json): '+json.dumps(groups)+'\n'
+            write(os.path.join(dir, 'index.md'), '---\n'+meta+'---\n'+sentence(rnd, 30)+'\n')
+    # The subpages of a multi-template page are written next to it, so each
+    # directory gets at most one such page
+    dir_pages = {}
+    for n in range(opts.pages):
+        format = FORMATS[n % len(FORMATS)]
+        dir = os.path.join(path, 'source', 's%d' % (n % sections))
+        for d in range(1, 1+(n/sections) % opts.depth):
+            dir = os.path.join(dir, 'd%d' % d)
+        dir_pages[dir] = dir_pages.get(dir, 0)+1
+        multi_template = dir_pages[dir] == opts.multi_template
+        write(os.path.join(dir, 'p%d.%s' % (n, format)), page_meta(rnd, opts, n, multi_template)+page_content(rnd, format, opts.paragraphs))
+
+
+def count_pages(website):
+    pages = 0
+    for (root, dirs, files) in os.walk(website):
+        pages += len([f for f in files if f.endswith('.html')])
+    return pages
+
+
+def run(site, name, yak, yak_args):
+    cmd = [sys.executable, yak, 'compile', '-w', 'website'] + yak_args
+    start = time.time()
+    p = subprocess.Popen(cmd, cwd=site, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.stdout.read()
+    (pid, status, usage) = os.wait4(p.pid, 0)
+    wall = time.time()-start
+    if status != 0:
+        print(output, file=sys.stderr)
+        raise Exception(' '.join(cmd)+' failed')
+    # ru_maxrss is reported in bytes on OS X and in kilobytes elsewhere
+    peak_rss = usage.ru_maxrss*(1 if sys.platform == 'darwin' else 1024)
+    pages = count_pages(os.path.join(site, 'website'))
+    return {
+        'name': name,
+        'wall': round(wall, 4),
+        'user': round(usage.ru_utime, 4),
+        'system': round(usage.ru_stime, 4),
+        'peak_rss': peak_rss,
+        'pages': pages,
+        'pages_per_second': round(pages/wall, 2)
+    }
+
+
+def clean(site, cache=True):
+    for d in ['website'] + (['.yak-cache'] if cache else []):
+        if os.path.isdir(os.path.join(site, d)):
+            shutil.rmtree(os.path.join(site, d))
+
+
+def benchmark(site, opts):
+    yak_args = ['--jobs', str(opts.jobs)]
+    runs = []
+    for i in range(opts.repeat):
+        # cold: no output and no caches, warm: caches kept, output rebuilt,
+        # incremental: nothing changed since the previous incremental build
+        clean(site)
+        runs.append(run(site, 'cold', opts.yak, yak_args))
+        clean(site, cache=False)
+        runs.append(run(site, 'warm', opts.yak, yak_args))
+        run(site, 'incremental', opts.yak, yak_args+['--incremental'])
+        runs.append(run(site, 'incremental', opts.yak, yak_args+['--incremental']))
+    summary = {}
+    for name in ['cold', 'warm', 'incremental']:
+        walls = sorted([r['wall'] for r in runs if r['name'] == name])
+        summary[name] = {
+            'median_wall': walls[len(walls)/2],
+            'min_wall': walls[0],
+            'max_peak_rss': max([r['peak_rss'] for r in runs if r['name'] == name])
+        }
+    return runs, summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark yak on a generated site')
+    parser.add_argument('--pages', '-n', type=int, help='the number of content pages', default=500)
+    parser.add_argument('--sections', type=int, help='the number of top level sections', default=5)
+    parser.add_argument('--depth', type=int, help='the nesting depth of each section', default=2)
+    parser.add_argument('--page-size', type=int, help='the page size of the Size groupings', default=10)
+    parser.add_argument('--tags', type=int, help='the number of distinct tags used by the Attribute groupings', default=20)
+    parser.add_argument('--paragraphs', type=int, help='the number of paragraphs per page', default=5)
+    parser.add_argument('--multi-template', type=int, help='make the n-th page of each directory a multi-template page (0 disables)', default=10)
+    parser.add_argument('--data-files', type=int, help='the number of json/csv data files referenced from meta', default=5)
+    parser.add_argument('--assets', type=int, help='the number of image assets', default=100)
+    parser.add_argument('--asset-size', type=int, help='the size of each image asset in bytes', default=16*1024)
+    parser.add_argument('--seed', type=int, help='the random seed used to generate the site', default=0)
+    parser.add_argument('--repeat', '-r', type=int, help='the number of times each build is repeated', default=3)
+    parser.add_argument('--jobs', '-j', type=int, help='passed to yak', default=1)
+    parser.add_argument('--yak', help='the yak.py to benchmark', default=YAK)
+    parser.add_argument('--site', help='generate the site into this directory and keep it', default=None)
+    parser.add_argument('--generate-only', action='store_true', help='only generate the site')
+    parser.add_argument('--output', '-o', help='write the results to this file instead of stdout', default=None)
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+    opts.yak = os.path.abspath(opts.yak)
+    site = opts.site or tempfile.mkdtemp(prefix='yak-bench-')
+    try:
+        for d in ['source', 'templates', 'assets', 'data']:
+            if os.path.isdir(os.path.join(site, d)):
+                shutil.rmtree(os.path.join(site, d))
+        generate(site, opts)
+        if opts.generate_only:
+            print(site)
+            return
+        runs, summary = benchmark(site, opts)
+    finally:
+        if opts.site is None:
+            shutil.rmtree(site)
+    result = {
+        'params': dict([(k, v) for (k, v) in vars(opts).items() if k not in ['site', 'output', 'generate_only']]),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': runs,
+        'summary': summary
+    }
+    if opts.output is None:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        with open(opts.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()